@@ -1,15 +1,20 @@
 
 import ccxt
+import ccxt.pro
+import asyncio
+import bisect
 import time
 import json
+import msgpack
 import os
 import logging
 import telebot
 import threading
-import concurrent.futures
+import copy
 import queue
 import signal
 import sys
+from collections import defaultdict, deque
 from functools import wraps
 from threading import Lock
 
@@ -34,18 +39,33 @@ for handler in logging.getLogger().handlers:
 profit_percent = 0.5 / 100  # 0.5%
 drop_percent = 1 / 100      # 1%
 delay_seconds = 30          # 30 секунд (для создания нового autobay)
+poll_interval = 5           # 5 секунд (между проверками ордеров)
 order_size = 15             # $15
-state_file = "bot_state.json"
+markets_reload_interval = 3600  # 1 час (перезагрузка списка рынков)
+telegram_global_rate = 30   # лимит Telegram: сообщений в секунду на бота
+telegram_chat_rate = 1      # лимит Telegram: сообщений в секунду в один чат
+state_file = "bot_state.msgpack"
+legacy_state_file = "bot_state.json"  # старый JSON-формат, читается один раз для миграции
 
 # Глобальные переменные
 notification_queue = queue.Queue()
 command_queue = queue.Queue()
+state_write_queue = queue.Queue()
 state_lock = Lock()
+send_rate_lock = Lock()
+request_lock = Lock()
+_next_request_time = 0  # когда можно отправить следующий REST-запрос к MEXC
+_send_times = deque()                   # время последних отправок (все чаты)
+_chat_send_times = defaultdict(deque)   # chat_id -> время последних отправок
+_state_cache = None  # последнее сохранённое состояние (источник истины — память)
 insufficient_funds_notified = False
 trading_stopped = False  # Флаг остановки трейдинга
-last_price = None
-last_price_time = 0
+_price_cache = {}    # symbol -> (цена, время)
+_balance_cache = {}  # currency -> (свободный баланс, время)
 price_cache_duration = 5
+balance_cache_duration = 5
+order_updates = {}   # id -> закрытый/отменённый ордер, полученный через websocket
+_markets_loaded_at = 0
 
 # Загрузка конфигурации из переменных окружения
 config = {
@@ -65,11 +85,23 @@ for section, keys in config.items():
         if value is None:
             raise ValueError(f"Переменная окружения {key.upper()} не задана")
 
-# Инициализация клиента MEXC
-exchange = ccxt.mexc({
+# Общие настройки клиентов MEXC
+exchange_options = {
     'apiKey': config['exchange']['api_key'],
     'secret': config['exchange']['secret'],
-})
+    'timeout': 30000,           # 30 сек вместо 10 сек по умолчанию в ccxt
+    'enableRateLimit': True,
+}
+
+# Инициализация клиента MEXC
+exchange = ccxt.mexc(dict(exchange_options))
+
+# Websocket-клиент MEXC для push-обновлений цены и ордеров.
+# Через него же параллельно запрашиваются статусы ордеров. У каждого клиента
+# свой ограничитель ccxt, поэтому REST-запросы обоих идут через общий
+# reserve_request_slot(): один ключ API — один лимит.
+stream_exchange = ccxt.pro.mexc(dict(exchange_options))
+stream_loop = asyncio.new_event_loop()
 
 # Инициализация Telegram-бота
 bot = telebot.TeleBot(config['telegram']['token'])
@@ -84,105 +116,267 @@ def retry_on_network_error(delay=5, max_delay=60):
             while True:
                 try:
                     return func(*args, **kwargs)
-                except ccxt.NetworkError as e:
+                except ccxt.NetworkError as e:  # в т.ч. RequestTimeout, ExchangeNotAvailable, DDoSProtection
                     attempt += 1
                     current_delay = min(delay * (2 ** min(attempt, 10)), max_delay)
-                    logging.warning(f"[NETWORK] Сетевая ошибка в {func.__name__}: {e}. Попытка {attempt}. Ожидаем {current_delay:.2f} сек")
+                    logging.warning("[NETWORK] Сетевая ошибка в %s: %s. Попытка %s. Ожидаем %.2f сек", func.__name__, e, attempt, current_delay)
                     time.sleep(current_delay)
                 except Exception as e:
                     raise e
         return wrapper
     return decorator
 
-# Функции работы с балансом и ценами
+# Общий лимит REST-запросов для exchange и stream_exchange
+def reserve_request_slot():
+    # Занимает ближайший свободный слот и возвращает, сколько секунд до него ждать
+    global _next_request_time
+    with request_lock:
+        now = time.time()
+        slot = max(now, _next_request_time)
+        _next_request_time = slot + exchange.rateLimit / 1000
+        return slot - now
+
+def wait_for_request_slot():
+    time.sleep(reserve_request_slot())
+
+# Функции работы с рынками, балансом и ценами
+@retry_on_network_error()
+def refresh_markets():
+    global _markets_loaded_at
+    if time.time() - _markets_loaded_at > markets_reload_interval:
+        wait_for_request_slot()
+        exchange.load_markets(reload=True)
+        _markets_loaded_at = time.time()
+
 @retry_on_network_error()
 def get_current_price(symbol):
-    global last_price, last_price_time
     current_time = time.time()
-    if last_price is None or current_time - last_price_time > price_cache_duration:
-        last_price = exchange.fetch_ticker(symbol)['last']
-        last_price_time = current_time
-    return last_price
+    cached = _price_cache.get(symbol)
+    if cached and current_time - cached[1] <= price_cache_duration:
+        return cached[0]
+    wait_for_request_slot()
+    price = exchange.fetch_ticker(symbol)['last']
+    _price_cache[symbol] = (price, current_time)
+    return price
 
 @retry_on_network_error()
 def get_available_balance(currency):
+    current_time = time.time()
+    cached = _balance_cache.get(currency)
+    if cached and current_time - cached[1] <= balance_cache_duration:
+        return cached[0]
+    wait_for_request_slot()
     balance = exchange.fetch_balance()
-    return balance.get(currency, {}).get('free', 0)
+    # Один запрос возвращает все валюты — кешируем их все
+    for code, value in balance.get('free', {}).items():
+        _balance_cache[code] = (value or 0, current_time)
+    free = balance.get(currency, {}).get('free', 0)
+    _balance_cache[currency] = (free, current_time)
+    return free
+
+def invalidate_balance_cache():
+    _balance_cache.clear()
+
+# Асинхронные запросы и websocket-подписки (выполняются в stream_loop)
+async def fetch_order_status(symbol, order):
+    try:
+        await asyncio.sleep(reserve_request_slot())
+        return order, await stream_exchange.fetch_order(order['id'], symbol)
+    except Exception as e:
+        logging.error("[ERROR] Ошибка проверки ордера %s: %s", order.get('id', 'N/A'), e)
+        return order, None
+
+async def fetch_order_statuses(symbol, orders):
+    return await asyncio.gather(*(fetch_order_status(symbol, order) for order in orders))
+
+async def watch_price(symbol):
+    # Тикер MEXC по websocket (bookTicker) не содержит last — берём цену последней сделки
+    while True:
+        try:
+            trades = await stream_exchange.watch_trades(symbol)
+            if trades and trades[-1].get('price') is not None:
+                _price_cache[symbol] = (trades[-1]['price'], time.time())
+        except Exception as e:
+            logging.warning("[WS] Ошибка подписки на цену %s: %s. Переподключение через 5 сек", symbol, e)
+            await asyncio.sleep(5)
+
+def is_final_ws_order(order):
+    if order.get('status') == 'canceled':
+        return True
+    if order.get('status') != 'closed':
+        return False
+    # ccxt.pro помечает 'closed' и частично исполненный, а затем отменённый ордер
+    # (в REST это 'canceled') — такой ордер проверяем через fetch_order
+    remaining = order.get('remaining')
+    filled = order.get('filled')
+    amount = order.get('amount')
+    return remaining == 0 or (filled is not None and amount is not None and filled >= amount)
+
+async def watch_orders(symbol):
+    while True:
+        try:
+            orders = await stream_exchange.watch_orders(symbol)
+            for order in orders:
+                if is_final_ws_order(order):
+                    order_updates[order['id']] = order
+        except Exception as e:
+            logging.warning("[WS] Ошибка подписки на ордера %s: %s. Переподключение через 5 сек", symbol, e)
+            await asyncio.sleep(5)
+
+def run_streams(symbol):
+    asyncio.set_event_loop(stream_loop)
+    stream_loop.create_task(watch_price(symbol))
+    stream_loop.create_task(watch_orders(symbol))
+    stream_loop.run_forever()
 
 # Сохранение и загрузка состояния
 def save_state(active_orders, executed_orders_count, total_profit):
-    global trading_stopped
+    global trading_stopped, _state_cache
     with state_lock:
         if not active_orders and executed_orders_count == 0 and total_profit == 0 and not trading_stopped:
             logging.warning("[WARNING] Не записываем state — данные пустые")
             return
         new_state = {
-            'active_orders': active_orders,
+            'active_orders': copy.deepcopy(active_orders),
             'executed_orders_count': executed_orders_count,
             'total_profit': total_profit,
             'trading_stopped': trading_stopped
         }
-        if os.path.exists(state_file):
-            try:
-                with open(state_file, "r", encoding='utf-8') as f:
-                    current_state = json.load(f)
-            except json.JSONDecodeError:
-                logging.error("[ERROR] Ошибка чтения JSON. Файл повреждён.")
-                current_state = {}
-            except Exception as e:
-                logging.error(f"[ERROR] Неизвестная ошибка при чтении JSON: {e}")
-                current_state = {}
-        else:
-            current_state = {}
-        if current_state == new_state:
+        if _state_cache == new_state:
             return
+        _state_cache = new_state
+        state_write_queue.put(new_state)
+
+def write_state_file(state):
+    # Пишем во временный файл и атомарно подменяем: сбой посреди записи не портит state
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(msgpack.packb(state, use_bin_type=True))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, state_file)
+
+def state_writer():
+    while True:
+        state = state_write_queue.get()
+        pending = 1
+        # Если накопилось несколько состояний, пишем только последнее
+        while True:
+            try:
+                state = state_write_queue.get_nowait()
+                pending += 1
+            except queue.Empty:
+                break
         try:
-            with open(state_file, "w", encoding='utf-8') as f:
-                json.dump(new_state, f, indent=4)
+            write_state_file(state)
             logging.info("[SAVE] Состояние бота сохранено.")
         except Exception as e:
-            logging.error(f"[ERROR] Ошибка при сохранении состояния: {e}")
+            logging.error("[ERROR] Ошибка при сохранении состояния: %s", e)
+        for _ in range(pending):
+            state_write_queue.task_done()
+
+def flush_state():
+    state_write_queue.join()
+
+def migrate_legacy_state():
+    # Разовая миграция bot_state.json -> bot_state.msgpack
+    if os.path.exists(state_file) or not os.path.exists(legacy_state_file):
+        return
+    try:
+        with open(legacy_state_file, "r", encoding='utf-8') as f:
+            state = json.load(f)
+        write_state_file(state)
+        logging.info("[LOAD] Состояние перенесено из %s в %s", legacy_state_file, state_file)
+    except Exception as e:
+        logging.error("[ERROR] Ошибка миграции %s: %s", legacy_state_file, e)
 
 def load_state():
-    global trading_stopped
+    global trading_stopped, _state_cache
+    migrate_legacy_state()
     if os.path.exists(state_file):
         try:
-            with open(state_file, "r", encoding='utf-8') as f:
-                state = json.load(f)
+            with open(state_file, "rb") as f:
+                state = msgpack.unpackb(f.read(), raw=False)
             trading_stopped = state.get('trading_stopped', False)
-            logging.info(f"[LOAD] Состояние успешно загружено из bot_state.json, trading_stopped={trading_stopped}")
+            with state_lock:
+                if _state_cache is None:
+                    _state_cache = copy.deepcopy(state)
+            logging.info("[LOAD] Состояние успешно загружено из %s, trading_stopped=%s", state_file, trading_stopped)
             return (
                 state.get('active_orders', []),
                 state.get('executed_orders_count', 0),
                 state.get('total_profit', 0)
             )
-        except json.JSONDecodeError as e:
-            logging.error(f"[ERROR] Ошибка чтения bot_state.json: {e}. Возвращаем пустое состояние.")
+        except ValueError as e:
+            logging.error("[ERROR] Ошибка чтения %s: %s. Возвращаем пустое состояние.", state_file, e)
             return [], 0, 0
         except Exception as e:
-            logging.error(f"[ERROR] Неизвестная ошибка при загрузке состояния: {e}. Возвращаем пустое состояние.")
+            logging.error("[ERROR] Неизвестная ошибка при загрузке состояния: %s. Возвращаем пустое состояние.", e)
             return [], 0, 0
-    logging.info("[LOAD] Файл bot_state.json не существует. Возвращаем пустое состояние.")
+    logging.info("[LOAD] Файл %s не существует. Возвращаем пустое состояние.", state_file)
     trading_stopped = False
     return [], 0, 0
 
+def get_state_snapshot():
+    # Для Telegram-обработчиков: читаем состояние из памяти, а не с диска
+    with state_lock:
+        state = dict(_state_cache) if _state_cache is not None else {}
+    return (
+        state.get('active_orders', []),
+        state.get('executed_orders_count', 0),
+        state.get('total_profit', 0)
+    )
+
 # Управление уведомлениями
 def save_notification(notification_message):
     notification_queue.put(notification_message)
-    logging.info(f"[NOTIFY] Уведомление добавлено: {notification_message}")
+    logging.info("[NOTIFY] Уведомление добавлено: %s", notification_message)
+
+def wait_for_send_slot(chat_id):
+    # Скользящее окно в 1 секунду: не больше telegram_global_rate сообщений всего
+    # и telegram_chat_rate сообщений в один чат
+    while True:
+        with send_rate_lock:
+            now = time.time()
+            chat_times = _chat_send_times[chat_id]
+            for times in (_send_times, chat_times):
+                while times and now - times[0] >= 1:
+                    times.popleft()
+            wait = 0
+            if len(_send_times) >= telegram_global_rate:
+                wait = max(wait, 1 - (now - _send_times[0]))
+            if len(chat_times) >= telegram_chat_rate:
+                wait = max(wait, 1 - (now - chat_times[0]))
+            if wait <= 0:
+                _send_times.append(now)
+                chat_times.append(now)
+                return
+        time.sleep(wait)
 
 def send_notifications():
     while True:
         try:
             message = notification_queue.get(timeout=5)
-            bot.send_message(CHAT_ID, message, timeout=10)
-            notification_queue.task_done()
-            logging.info("[NOTIFY] Уведомление отправлено")
         except queue.Empty:
             continue
+        try:
+            while True:
+                wait_for_send_slot(CHAT_ID)
+                try:
+                    bot.send_message(CHAT_ID, message, timeout=10)
+                    break
+                except telebot.apihelper.ApiTelegramException as e:
+                    if e.error_code != 429:
+                        raise
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 5)
+                    logging.warning("[NOTIFY] Лимит Telegram (429). Ожидаем %s сек", retry_after)
+                    time.sleep(retry_after)
+            logging.info("[NOTIFY] Уведомление отправлено")
         except Exception as e:
-            logging.error(f"[ERROR] Ошибка при отправке уведомления: {e}")
+            logging.error("[ERROR] Ошибка при отправке уведомления: %s", e)
             time.sleep(5)
+        finally:
+            notification_queue.task_done()
 
 # Функции работы с ордерами
 @retry_on_network_error()
@@ -190,26 +384,29 @@ def create_buy_order(symbol, amount):
     global insufficient_funds_notified
     for attempt in range(3):
         try:
+            wait_for_request_slot()
             order = exchange.create_market_buy_order(symbol, amount)
+            wait_for_request_slot()
             actual_price = exchange.fetch_order(order['id'], symbol)['average']
-            logging.info(f"[BUY] Куплено {amount} по {actual_price}")
+            logging.info("[BUY] Куплено %s по %s", amount, actual_price)
+            invalidate_balance_cache()
             insufficient_funds_notified = False
             return order, actual_price
         except ccxt.InsufficientFunds as e:
-            logging.error(f"[ERROR] Недостаточно средств для покупки: {e}")
+            logging.error("[ERROR] Недостаточно средств для покупки: %s", e)
             if not insufficient_funds_notified:
                 save_notification(f"[ERROR] Недостаточно средств для покупки")
                 insufficient_funds_notified = True
             return None, None
         except ccxt.RateLimitExceeded as e:
-            logging.warning(f"[RATE] Превышен лимит запросов: {e}. Ожидаем...")
+            logging.warning("[RATE] Превышен лимит запросов: %s. Ожидаем...", e)
             time.sleep(2 ** attempt)
         except ccxt.OrderNotFound as e:
-            logging.error(f"[ERROR] Ордер не найден: {e}")
+            logging.error("[ERROR] Ордер не найден: %s", e)
             save_notification(f"[ERROR] Ордер не найден")
             return None, None
         except Exception as e:
-            logging.error(f"[ERROR] Неизвестная ошибка покупки: {e}")
+            logging.error("[ERROR] Неизвестная ошибка покупки: %s", e)
             save_notification(f"[ERROR] Ошибка покупки: {e}")
             return None, None
     logging.error("[ERROR] Не удалось создать ордер после 3 попыток")
@@ -220,40 +417,48 @@ def create_sell_order(symbol, amount, price):
     global insufficient_funds_notified
     for attempt in range(3):
         try:
+            wait_for_request_slot()
             order = exchange.create_limit_sell_order(symbol, amount, price)
-            logging.info(f"[SELL] Ордер на продажу {amount} по {price} создан.")
+            logging.info("[SELL] Ордер на продажу %s по %s создан.", amount, price)
+            invalidate_balance_cache()
             insufficient_funds_notified = False
             return order
         except ccxt.InsufficientFunds as e:
-            logging.error(f"[ERROR] Недостаточно средств для продажи: {e}")
+            logging.error("[ERROR] Недостаточно средств для продажи: %s", e)
             if not insufficient_funds_notified:
                 save_notification(f"[ERROR] Недостаточно средств для продажи")
                 insufficient_funds_notified = True
             return None
         except ccxt.RateLimitExceeded as e:
-            logging.warning(f"[RATE] Превышен лимит запросов: {e}. Ожидаем...")
+            logging.warning("[RATE] Превышен лимит запросов: %s. Ожидаем...", e)
             time.sleep(2 ** attempt)
         except ccxt.OrderNotFound as e:
-            logging.error(f"[ERROR] Ордер не найден: {e}")
+            logging.error("[ERROR] Ордер не найден: %s", e)
             save_notification(f"[ERROR] Ордер не найден")
             return None
         except Exception as e:
-            logging.error(f"[ERROR] Ошибка продажи: {e}")
+            logging.error("[ERROR] Ошибка продажи: %s", e)
             save_notification(f"[ERROR] Ошибка продажи: {e}")
             return None
     logging.error("[ERROR] Не удалось создать ордер после 3 попыток")
     return None
 
-def create_new_order(symbol, active_orders, executed_orders_count, total_profit, order_type):
+# active_orders всегда отсортирован по цене продажи: самый дешёвый ордер — первый
+def order_price(order):
+    return order.get('price', float('inf'))
+
+def insert_order(active_orders, order):
+    bisect.insort(active_orders, order, key=order_price)
+
+def create_new_order(symbol, quote_currency, active_orders, executed_orders_count, total_profit, order_type):
     global insufficient_funds_notified
-    exchange.load_markets()
+    refresh_markets()
     current_price = get_current_price(symbol)
-    base_currency = symbol.split('/')[1]
-    available_balance = get_available_balance(base_currency)
+    available_balance = get_available_balance(quote_currency)
 
     if available_balance < order_size:
         if not insufficient_funds_notified:
-            msg = f"[ERROR] Недостаточно средств ({base_currency}): {available_balance:.2f} USDT"
+            msg = f"[ERROR] Недостаточно средств ({quote_currency}): {available_balance:.2f} USDT"
             logging.warning(msg)
             save_notification(msg)
             insufficient_funds_notified = True
@@ -275,7 +480,7 @@ def create_new_order(symbol, active_orders, executed_orders_count, total_profit,
 
     sell_order = create_sell_order(symbol, bought_amount, sell_price)
     if sell_order:
-        active_orders.append({
+        insert_order(active_orders, {
             'id': sell_order['id'],
             'amount': bought_amount,
             'price': sell_price,
@@ -288,27 +493,44 @@ def create_new_order(symbol, active_orders, executed_orders_count, total_profit,
 
     return active_orders, executed_orders_count, total_profit
 
-def check_orders(symbol, active_orders, executed_orders_count, total_profit, initial_check=False):
+def check_orders(symbol, quote_currency, active_orders, executed_orders_count, total_profit, initial_check=False):
     global trading_stopped
     logging.debug("[CHECK] Проверка статуса ордеров...")
     if initial_check:
         save_notification("[CHECK] Проверка статуса ранее созданных ордеров...")
 
-    def fetch_order_status(order):
-        time.sleep(0.2)
-        try:
-            return order, exchange.fetch_order(order['id'], symbol)
-        except Exception as e:
-            logging.error(f"[ERROR] Ошибка проверки ордера {order.get('id', 'N/A')}: {e}")
-            return order, None
-
     try:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
-            results = list(executor.map(fetch_order_status, active_orders))
+        wait_for_request_slot()
+        open_orders = {o['id']: o for o in exchange.fetch_open_orders(symbol)}
     except Exception as e:
-        logging.error(f"[ERROR] Ошибка в ThreadPoolExecutor: {e}")
+        logging.error("[ERROR] Ошибка получения открытых ордеров: %s", e)
         return active_orders, executed_orders_count, total_profit
 
+    # Статусы, уже пришедшие через websocket, повторно не запрашиваем
+    pushed_statuses = {o['id']: order_updates.pop(o['id']) for o in active_orders if o['id'] in order_updates}
+    # Остальное (рыночные покупки, ручные ордера, уже проверенные через REST) нам не нужно
+    tracked_ids = {o['id'] for o in active_orders}
+    for order_id in list(order_updates):
+        if order_id not in tracked_ids:
+            order_updates.pop(order_id, None)
+
+    # Отдельно запрашиваем только ордера, которых уже нет среди открытых (исполнены или отменены)
+    missing_orders = [o for o in active_orders if o['id'] not in open_orders and o['id'] not in pushed_statuses]
+    missing_statuses = {}
+    if missing_orders:
+        try:
+            future = asyncio.run_coroutine_threadsafe(fetch_order_statuses(symbol, missing_orders), stream_loop)
+            for order, order_status in future.result(timeout=60):
+                missing_statuses[order['id']] = order_status
+        except Exception as e:
+            logging.error("[ERROR] Ошибка запроса статусов ордеров: %s", e)
+            return active_orders, executed_orders_count, total_profit
+
+    results = [
+        (order, pushed_statuses.get(order['id']) or open_orders.get(order['id']) or missing_statuses.get(order['id']))
+        for order in active_orders
+    ]
+
     try:
         updated_orders = []
         closed_orders = []
@@ -348,19 +570,20 @@ def check_orders(symbol, active_orders, executed_orders_count, total_profit, ini
                 f"Прибыль: {profit:.6f} USD"
             )
             logging.info(
-                f"[SUCCESS] Ордер выполнен: Тип={order.get('order_type', 'N/A')}, "
-                f"Количество={order['amount']:.6f} KAS, Покупка={order['buy_price']:.6f} USDT, "
-                f"Продажа={order['price']:.6f} USDT, Прибыль={profit:.6f} USD"
+                "[SUCCESS] Ордер выполнен: Тип=%s, "
+                "Количество=%.6f KAS, Покупка=%.6f USDT, "
+                "Продажа=%.6f USDT, Прибыль=%.6f USD",
+                order.get('order_type', 'N/A'), order['amount'], order['buy_price'], order['price'], profit
             )
 
         for order in canceled_orders:
-            logging.info(f"[CANCEL] Ордер {order['id']} отменен.")
+            logging.info("[CANCEL] Ордер %s отменен.", order['id'])
             save_notification(f"[CANCEL] Ордер {order['id']} отменен.")
 
         if initial_check and not updated_orders:
             if not trading_stopped:
                 logging.info("[START] Ордеров нет. Создаем 'autobay'.")
-                return create_new_order(symbol, updated_orders, executed_orders_count, total_profit, "autobay")
+                return create_new_order(symbol, quote_currency, updated_orders, executed_orders_count, total_profit, "autobay")
             else:
                 logging.info("[START] Ордеров нет, но трейдинг остановлен. Не создаем 'autobay'.")
                 return updated_orders, executed_orders_count, total_profit
@@ -368,11 +591,9 @@ def check_orders(symbol, active_orders, executed_orders_count, total_profit, ini
         if not trading_stopped:
             if flagautobay == 0 and updated_orders:
                 logging.info("[UPDATE] Назначаем новый 'autobay'.")
-                updated_orders.sort(key=lambda x: x.get('price', float('inf')))
                 updated_orders[0]['order_type'] = 'autobay'
             elif flagautobay > 1:
                 logging.info("[WARNING] Несколько 'autobay'. Оставляем самый дешевый.")
-                updated_orders.sort(key=lambda x: x.get('price', float('inf')))
                 first_autobay = True
                 for order in updated_orders:
                     if order.get('order_type') == 'autobay':
@@ -381,89 +602,110 @@ def check_orders(symbol, active_orders, executed_orders_count, total_profit, ini
                         else:
                             order['order_type'] = 'bay'
 
-        save_state(updated_orders, executed_orders_count, total_profit)
-
         if autobay_needed and not initial_check and not trading_stopped:
             time.sleep(delay_seconds)
             updated_orders, executed_orders_count, total_profit = create_new_order(
-                symbol, updated_orders, executed_orders_count, total_profit, "autobay"
+                symbol, quote_currency, updated_orders, executed_orders_count, total_profit, "autobay"
             )
-            save_state(updated_orders, executed_orders_count, total_profit)
 
         if initial_check:
             save_notification("Проверка ранее созданных ордеров завершена.")
 
         return updated_orders, executed_orders_count, total_profit
     except Exception as e:
-        logging.error(f"[ERROR] Неизвестная ошибка в check_orders: {e}")
+        logging.error("[ERROR] Неизвестная ошибка в check_orders: %s", e)
         return active_orders, executed_orders_count, total_profit
 
 # Основная функция бота
+def order_keys(active_orders):
+    # Всё, что check_orders может поменять в списке ордеров
+    return [(o.get('id'), o.get('order_type')) for o in active_orders]
+
 def run_bot(symbol):
     global insufficient_funds_notified, trading_stopped
-    logging.info(f"[START] Запуск бота для {symbol}")
+    logging.info("[START] Запуск бота для %s", symbol)
+    quote_currency = symbol.split('/')[1]
+    try:
+        refresh_markets()
+    except Exception as e:
+        # Не роняем поток: рынки ещё раз попробуем загрузить в create_new_order
+        logging.error("[ERROR] Ошибка загрузки рынков при запуске: %s", e)
     active_orders, executed_orders_count, total_profit = load_state()
+    active_orders.sort(key=order_price)
     active_orders, executed_orders_count, total_profit = check_orders(
-        symbol, active_orders, executed_orders_count, total_profit, initial_check=True
+        symbol, quote_currency, active_orders, executed_orders_count, total_profit, initial_check=True
     )
     save_state(active_orders, executed_orders_count, total_profit)
 
+    next_tick = time.time()
     while True:
+        state_dirty = False
         try:
-            command = command_queue.get_nowait()
+            # Ждём команду до следующей проверки ордеров, а не крутимся вхолостую
+            command = command_queue.get(timeout=max(0, next_tick - time.time()))
             if command == "stop":
                 logging.info("[STOP] Трейдинг остановлен.")
                 trading_stopped = True
+                state_dirty = True
                 for order in active_orders:
                     if order.get("order_type") == "autobay":
                         order["order_type"] = "bay"
-                        save_state(active_orders, executed_orders_count, total_profit)
                         save_notification(f"[STOP] Трейдинг остановлен. Ордер {order['id']} переведен в 'bay'.")
                         break
                 else:
                     save_notification("[STOP] Ордеров 'autobay' нет.")
-                save_state(active_orders, executed_orders_count, total_profit)
             elif command == "start":
                 logging.info("[START] Трейдинг запущен.")
                 trading_stopped = False
                 insufficient_funds_notified = False
                 active_orders, executed_orders_count, total_profit = check_orders(
-                    symbol, active_orders, executed_orders_count, total_profit, initial_check=True
+                    symbol, quote_currency, active_orders, executed_orders_count, total_profit, initial_check=True
                 )
-                save_state(active_orders, executed_orders_count, total_profit)
+                state_dirty = True
             elif command == "buy":
                 active_orders, executed_orders_count, total_profit = create_new_order(
-                    symbol, active_orders, executed_orders_count, total_profit, "bay"
+                    symbol, quote_currency, active_orders, executed_orders_count, total_profit, "bay"
                 )
-                save_state(active_orders, executed_orders_count, total_profit)
+                state_dirty = True
                 save_notification("[BUY] Создан ордер 'bay'.")
         except queue.Empty:
             pass
 
-        active_orders, executed_orders_count, total_profit = check_orders(
-            symbol, active_orders, executed_orders_count, total_profit
-        )
-        active_orders.sort(key=lambda x: x.get('price', float('inf')))
-        save_state(active_orders, executed_orders_count, total_profit)
-
-        autobay_order = next((o for o in active_orders if o.get("order_type") == "autobay"), None)
-        current_price = get_current_price(symbol)
-        if autobay_order and current_price <= autobay_order['buy_price'] * (1 - drop_percent) and not trading_stopped:
-            base_currency = symbol.split('/')[1]
-            available_balance = get_available_balance(base_currency)
-            if available_balance >= order_size:
-                logging.info(f"[UPDATE] Цена упала до {current_price:.6f}. Заменяем autobay.")
-                autobay_order['order_type'] = "bay"
-                active_orders, executed_orders_count, total_profit = create_new_order(
-                    symbol, active_orders, executed_orders_count, total_profit, "autobay"
-                )
-                save_state(active_orders, executed_orders_count, total_profit)
-            else:
-                if not insufficient_funds_notified:
-                    msg = f"[ERROR] Недостаточно средств ({base_currency}): {available_balance:.2f} USDT"
-                    logging.warning(msg)
-                    save_notification(msg)
-                    insufficient_funds_notified = True
+        if trading_stopped and not active_orders:
+            # Трейдинг остановлен и ордеров нет — проверять нечего, просто ждём команду.
+            # Отслеживаемых ордеров нет, поэтому все websocket-обновления можно выбросить
+            order_updates.clear()
+            next_tick = time.time() + poll_interval
+        elif time.time() >= next_tick:
+            next_tick = time.time() + poll_interval
+            orders_before = order_keys(active_orders)
+            executed_before = executed_orders_count
+            active_orders, executed_orders_count, total_profit = check_orders(
+                symbol, quote_currency, active_orders, executed_orders_count, total_profit
+            )
+            if executed_orders_count != executed_before or order_keys(active_orders) != orders_before:
+                state_dirty = True
+
+            autobay_order = next((o for o in active_orders if o.get("order_type") == "autobay"), None)
+            current_price = get_current_price(symbol)
+            if autobay_order and current_price <= autobay_order['buy_price'] * (1 - drop_percent) and not trading_stopped:
+                available_balance = get_available_balance(quote_currency)
+                if available_balance >= order_size:
+                    logging.info("[UPDATE] Цена упала до %.6f. Заменяем autobay.", current_price)
+                    autobay_order['order_type'] = "bay"
+                    active_orders, executed_orders_count, total_profit = create_new_order(
+                        symbol, quote_currency, active_orders, executed_orders_count, total_profit, "autobay"
+                    )
+                    state_dirty = True
+                else:
+                    if not insufficient_funds_notified:
+                        msg = f"[ERROR] Недостаточно средств ({quote_currency}): {available_balance:.2f} USDT"
+                        logging.warning(msg)
+                        save_notification(msg)
+                        insufficient_funds_notified = True
+
+        if state_dirty:
+            save_state(active_orders, executed_orders_count, total_profit)
 
 # Telegram-обработчики
 @bot.message_handler(commands=['stop'])
@@ -478,7 +720,7 @@ def start_trading(message):
 
 @bot.message_handler(commands=['stats'])
 def send_stats(message):
-    active_orders, executed_orders_count, total_profit = load_state()
+    active_orders, executed_orders_count, total_profit = get_state_snapshot()
     stats_message = (
         f"[STATS] Статистика:\n"
         f"Выполнено ордеров: {executed_orders_count}\n"
@@ -491,12 +733,15 @@ def send_stats(message):
 def send_balance(message):
     try:
         current_price = get_current_price("KAS/USDT")
-        active_orders, executed_orders_count, total_profit = load_state()
+        active_orders, executed_orders_count, total_profit = get_state_snapshot()
         usdt_balance = get_available_balance("USDT")
         kas_balance = get_available_balance("KAS")
-        frozen_usdt = sum(order["amount"] * order["price"] for order in active_orders)
-        frozen_kas = sum(order["amount"] for order in active_orders)
-        total_sell_value = sum(order["amount"] * current_price for order in active_orders)
+        frozen_usdt = 0.0
+        frozen_kas = 0.0
+        for order in active_orders:
+            frozen_usdt += order["amount"] * order["price"]
+            frozen_kas += order["amount"]
+        total_sell_value = frozen_kas * current_price
         PnL = ((total_sell_value + usdt_balance) / (frozen_usdt + usdt_balance - total_profit) - 1) * 100
         balance_message = (
             "<u>БАЛАНС</u>\n\n"
@@ -513,7 +758,7 @@ def send_balance(message):
         )
         bot.reply_to(message, balance_message, parse_mode="HTML")
     except Exception as e:
-        logging.error(f"[ERROR] Ошибка при получении баланса: {e}")
+        logging.error("[ERROR] Ошибка при получении баланса: %s", e)
         bot.reply_to(message, "[ERROR] Произошла ошибка при получении баланса.")
 
 @bot.message_handler(commands=['price'])
@@ -523,7 +768,7 @@ def send_price(message):
         price_message = f"[PRICE] Текущая цена KAS: {current_price:.6f} USDT"
         bot.reply_to(message, price_message)
     except Exception as e:
-        logging.error(f"[ERROR] Ошибка при получении цены: {e}")
+        logging.error("[ERROR] Ошибка при получении цены: %s", e)
         bot.reply_to(message, "[ERROR] Произошла ошибка при получении текущей цены.")
 
 @bot.message_handler(commands=['buy'])
@@ -532,7 +777,18 @@ def buy_order(message):
     command_queue.put("buy")
 
 # Обработка сигналов
+def close_streams():
+    # Закрываем общую сессию и websocket-соединения async-клиента
+    if not stream_loop.is_running():
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(stream_exchange.close(), stream_loop).result(timeout=5)
+    except Exception as e:
+        logging.error("[ERROR] Ошибка при закрытии соединений с биржей: %s", e)
+
 def handle_exit(signum, frame):
+    flush_state()
+    close_streams()
     logging.info("[EXIT] Бот остановлен вручную. Состояние сохранено.")
     sys.exit(0)
 
@@ -542,6 +798,9 @@ signal.signal(signal.SIGTERM, handle_exit)
 # Запуск
 if __name__ == "__main__":
     symbol = "KAS/USDT"
+    threading.Thread(target=state_writer, daemon=True).start()
+    threading.Thread(target=run_streams, args=(symbol,), daemon=True).start()
     threading.Thread(target=run_bot, args=(symbol,), daemon=True).start()
+    # Один поток отправки: уведомления в чат должны приходить в порядке очереди
     threading.Thread(target=send_notifications, daemon=True).start()
     bot.polling()